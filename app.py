@@ -1,23 +1,48 @@
+import io
 import os
+import queue
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
 import streamlit as st
 import pandas as pd
 from dotenv import load_dotenv
 from jira import JIRA
 import google.generativeai as genai
-from main import parse_markdown_table, clean_html_br_tags_and_strip
+from main import (
+    GENERATION_CONFIG,
+    RETRYABLE_ERRORS,
+    backoff_delay,
+    clean_html_br_tags_in_frame,
+    combine_test_case_frames,
+    parse_test_cases,
+    test_cases_to_frame,
+    trim_description,
+)
 
 # --- Load .env only when not running on Streamlit Cloud ---
 if not os.environ.get("STREAMLIT_RUNTIME"):
     load_dotenv()
 
 # --- Constants ---
-OUTPUT_DIR = os.path.join(os.getcwd(), "output")
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-
 FILENAME = "jira_test_cases.xlsx"
 MAX_RETRIES = 3
 RETRY_DELAY = 5
+MAX_WORKERS = 8
+STREAM_REFRESH = 0.25  # seconds between streamed output redraws
+STORY_FIELDS = "summary,description"
+STORY_CACHE_TTL = 600  # seconds
+GENERATION_CACHE_TTL = 86400  # seconds
+
+PROMPT_TEMPLATE = """
+You are a highly skilled QA engineer. Given the following Jira user story, generate detailed {test_types} test cases with depth {depth} and return them as a JSON array.
+Each test case should cover unique scenarios (positive and negative) with preconditions, clear multi-step steps, and explicit expected results.
+
+Jira Story Summary: {summary}
+Jira Description: {description}
+
+Output only the JSON array, one object per test case.
+"""
 
 # --- Environment Variables ---
 JIRA_EMAIL = os.getenv("JIRA_EMAIL")
@@ -41,10 +66,27 @@ if missing:
     st.error(f"❌ Missing environment variables: {', '.join(missing)}. Please add them to Streamlit Secrets.")
     st.stop()
 
+# --- Shared Clients ---
+@st.cache_resource(show_spinner=False)
+def get_jira():
+    """Create the JIRA client once per server process."""
+    return JIRA(server=JIRA_SERVER, basic_auth=(JIRA_EMAIL, JIRA_API_TOKEN))
+
+@st.cache_data(show_spinner=False, ttl=300)
+def get_project_keys():
+    """Return the keys of all JIRA projects visible to the configured user."""
+    return [p.key for p in get_jira().projects()]
+
+@st.cache_resource(show_spinner=False)
+def get_model(model_name):
+    """Configure Gemini and create the model handle once per model name."""
+    # gRPC is already the SDK default; it is set here only to make the choice explicit.
+    genai.configure(api_key=GEMINI_API_KEY, transport="grpc")
+    return genai.GenerativeModel(model_name, generation_config=GENERATION_CONFIG)
+
 # --- Configure Gemini ---
 try:
-    genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel(GEMINI_MODEL)
+    get_model(GEMINI_MODEL)
 except Exception as e:
     st.error(f"⚠️ Failed to initialize Gemini model: {e}")
     st.stop()
@@ -64,9 +106,7 @@ st.markdown(
 
 # --- JIRA Connection ---
 try:
-    jira = JIRA(server=JIRA_SERVER, basic_auth=(JIRA_EMAIL, JIRA_API_TOKEN))
-    all_projects = jira.projects()
-    project_keys = [p.key for p in all_projects]
+    project_keys = get_project_keys()
 except Exception as e:
     st.error(f"⚠️ Jira connection failed: {e}")
     st.stop()
@@ -79,29 +119,53 @@ selected_project = st.selectbox(
     index=project_keys.index(PROJECT_KEY) if PROJECT_KEY in project_keys else 0
 )
 
-@st.cache_data(show_spinner=False)
-def fetch_stories(_jira_client, project_key):
-    """Fetch up to 50 latest user stories from a JIRA project."""
-    return _jira_client.search_issues(
+@st.cache_data(show_spinner=False, persist="disk")
+def fetch_stories(project_key, fields=STORY_FIELDS):
+    """Fetch up to 50 latest user stories from a JIRA project as plain dicts."""
+    issues = get_jira().search_issues(
         f'project={project_key} AND issuetype=Story ORDER BY created DESC',
-        maxResults=50
+        maxResults=50,
+        fields=fields,
     )
+    stories = [
+        {"key": issue.key, **{f: getattr(issue.fields, f, None) for f in fields.split(",")}}
+        for issue in issues
+    ]
+    return {"fetched_at": time.time(), "stories": stories}
+
+def load_stories(project_key):
+    """Return a project's stories, refetching them once older than STORY_CACHE_TTL.
+
+    Disk-persisted caches ignore ttl, so the age is checked here and the stale
+    entry is replaced in place, keeping one cache file per project.
+    """
+    cached = fetch_stories(project_key)
+    if time.time() - cached["fetched_at"] > STORY_CACHE_TTL:
+        fetch_stories.clear(project_key)
+        cached = fetch_stories(project_key)
+    return cached["stories"]
 
 
 # --- Load Stories ---
-issues = []
+# Stories are kept per project in session state so that changing sidebar
+# options only reruns the UI instead of reloading them.
+loaded_stories = st.session_state.setdefault("stories", {})
+key_to_issue = {}
 if selected_project:
     try:
-        issues = fetch_stories(jira, selected_project)
-        if not issues:
+        if selected_project not in loaded_stories:
+            loaded_stories[selected_project] = {
+                f"{story['key']}: {story['summary']}": story
+                for story in load_stories(selected_project)
+            }
+        key_to_issue = loaded_stories[selected_project]
+        if not key_to_issue:
             st.warning(f"No user stories found in project **{selected_project}**.")
         else:
-            st.success(f"✅ Loaded {len(issues)} stories from **{selected_project}**.")
+            st.success(f"✅ Loaded {len(key_to_issue)} stories from **{selected_project}**.")
     except Exception as e:
         st.error(f"⚠️ Failed to load stories for {selected_project}: {e}")
 
-story_options = [f"{issue.key}: {issue.fields.summary}" for issue in issues] if issues else []
-
 # --- Sidebar Options ---
 st.sidebar.header("⚙️ Test Case Generation Settings")
 depth = st.sidebar.slider("Test case depth", 1, 5, 3)
@@ -111,99 +175,176 @@ test_types = st.sidebar.multiselect(
     default=["Functional"],
 )
 export_format = st.sidebar.radio("Choose export format", ["Excel", "CSV"])
+force_regenerate = st.sidebar.checkbox(
+    "Force regenerate",
+    help="Skip cached results for the selected stories and call Gemini again.",
+)
 
 # --- Multiselect Stories ---
 selected_story_keys = st.multiselect(
     "Select Jira User Stories",
-    options=story_options,
+    options=list(key_to_issue),
     help="Select one or more stories for which you want to generate test cases.",
 )
 
 # --- Helper Functions ---
-def generate_test_cases(prompt_text):
+class UnusableResponseError(ValueError):
+    """Raised when Gemini's response contains no parseable test cases."""
+
+def _generate(prompt_text, model_name, on_chunk=None):
+    """Stream one Gemini response, passing the text so far to on_chunk.
+
+    Raises UnusableResponseError for truncated or empty output, so that it is
+    retried and never cached.
+    """
+    chunks = []
+    for chunk in get_model(model_name).generate_content(prompt_text, stream=True):
+        chunks.append(chunk.text)
+        if on_chunk:
+            on_chunk("".join(chunks))
+    text = "".join(chunks)
+    if not parse_test_cases(text):
+        raise UnusableResponseError("Gemini returned no usable test cases")
+    return text
+
+@st.cache_data(show_spinner=False, persist="disk")
+def _cached_generate(prompt_text, model_name, _on_chunk=None):
+    """Call Gemini once per (prompt, model) pair and cache the response text.
+
+    _on_chunk is not part of the cache key.
+    """
+    return {"generated_at": time.time(), "text": _generate(prompt_text, model_name, _on_chunk)}
+
+def cached_generate(prompt_text, model_name, on_chunk=None, refresh=False):
+    """Return the cached response for a prompt, regenerating it when forced or stale.
+
+    Disk-persisted caches ignore ttl, so the age is checked here and only this
+    prompt's entry is replaced.
+    """
+    if refresh:
+        _cached_generate.clear(prompt_text, model_name)
+    cached = _cached_generate(prompt_text, model_name, on_chunk)
+    if time.time() - cached["generated_at"] > GENERATION_CACHE_TTL:
+        _cached_generate.clear(prompt_text, model_name)
+        cached = _cached_generate(prompt_text, model_name, on_chunk)
+    return cached["text"]
+
+def generate_test_cases(prompt_text, messages, on_chunk=None, refresh=False):
+    """Generate test cases, queuing retry warnings for the main thread."""
     for attempt in range(1, MAX_RETRIES + 1):
         try:
-            response = model.generate_content(prompt_text)
-            return response.text
-        except Exception as e:
+            return cached_generate(prompt_text, GEMINI_MODEL, on_chunk, refresh)
+        except (*RETRYABLE_ERRORS, UnusableResponseError) as e:
             if attempt < MAX_RETRIES:
-                st.warning(f"⚠️ Retry {attempt}/{MAX_RETRIES} due to error: {e}")
-                time.sleep(RETRY_DELAY)
+                messages.put(f"⚠️ Retry {attempt}/{MAX_RETRIES} due to error: {e}")
+                time.sleep(backoff_delay(attempt, RETRY_DELAY))
+        except Exception as e:
+            messages.put(f"⚠️ Gemini request failed: {e}")
+            return ""
     return ""
 
 def generate_all_test_cases(selected_issues):
-    all_rows = []
     test_type_str = ", ".join(test_types) if test_types else "Functional"
 
     progress_bar = st.progress(0)
     total = len(selected_issues)
 
-    for i, issue in enumerate(selected_issues, 1):
-        story_summary = issue.fields.summary
-        story_description = issue.fields.description or "No description provided."
-
-        st.info(f"🧩 Generating test cases for **{issue.key}** — {story_summary}")
-
-        prompt = f"""
-You are a highly skilled QA engineer. Given the following Jira user story, generate detailed {test_type_str} test cases with depth {depth} and format them in a Markdown table.
-Each test case should cover unique scenarios (positive and negative) with preconditions, clear multi-step steps, and explicit expected results.
-
-Jira Story Summary: {story_summary}
-Jira Description: {story_description}
-
-Output only a Markdown table with columns:
-| Test Case ID | Test Scenario | Preconditions | Steps | Expected Result | Priority |
-"""
-
-        test_table_md = generate_test_cases(prompt)
-        case_rows = parse_markdown_table(test_table_md)
-
-        for row in case_rows:
-            row["Jira ID"] = issue.key
-            row["Story Summary"] = story_summary
-            all_rows.append(row)
-
-        progress_bar.progress(i / total)
+    prompts = []
+    placeholders = {}
+    for issue in selected_issues:
+        story_summary = issue["summary"]
+        story_description = trim_description(issue["description"]) or "No description provided."
+
+        st.info(f"🧩 Generating test cases for **{issue['key']}** — {story_summary}")
+        placeholders[issue["key"]] = st.empty()
+
+        prompt = PROMPT_TEMPLATE.format(
+            test_types=test_type_str,
+            depth=depth,
+            summary=story_summary,
+            description=story_description,
+        )
+        prompts.append((issue, prompt))
+
+    # Gemini calls are network-bound, so run them concurrently. Streamlit
+    # elements are only touched from this thread; workers queue their messages
+    # and publish streamed text, which is redrawn here every STREAM_REFRESH.
+    messages = queue.Queue()
+    streamed, rendered = {}, {}
+    results = {}
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, total)) as executor:
+        futures = {
+            executor.submit(
+                generate_test_cases,
+                prompt,
+                messages,
+                partial(streamed.__setitem__, issue["key"]),
+                refresh=force_regenerate,
+            ): issue
+            for issue, prompt in prompts
+        }
+        pending = set(futures)
+        while pending:
+            finished, pending = wait(pending, timeout=STREAM_REFRESH, return_when=FIRST_COMPLETED)
+            for future in finished:
+                results[futures[future]["key"]] = future.result()
+            progress_bar.progress(len(results) / total)
+            for key, text in list(streamed.items()):
+                if rendered.get(key) != text:
+                    placeholders[key].code(text, language="json")
+                    rendered[key] = text
+
+    for placeholder in placeholders.values():
+        placeholder.empty()
+
+    while not messages.empty():
+        st.warning(messages.get())
+
+    frames = []
+    for issue in selected_issues:
+        case_rows = parse_test_cases(results[issue["key"]])
+        if case_rows:
+            frames.append(test_cases_to_frame(case_rows, issue["key"], issue["summary"]))
 
     progress_bar.empty()
-    return all_rows
+    return combine_test_case_frames(frames)
 
 # --- Generate Button ---
 if st.button("🚀 Generate Test Cases"):
     if not selected_story_keys:
         st.warning("Please select at least one user story.")
     else:
-        selected_issues = [issues[story_options.index(k)] for k in selected_story_keys]
+        selected_issues = [key_to_issue[k] for k in selected_story_keys]
 
         with st.spinner("🧠 Generating test cases... please wait..."):
-            test_cases = generate_all_test_cases(selected_issues)
+            df = generate_all_test_cases(selected_issues)
 
-        if test_cases:
-            for row in test_cases:
-                for key, value in row.items():
-                    if isinstance(value, str):
-                        row[key] = clean_html_br_tags_and_strip(value)
-
-            df = pd.DataFrame(test_cases)
+        if not df.empty:
+            df = clean_html_br_tags_in_frame(df)
             st.success("✅ Test cases generated successfully!")
             st.dataframe(df, use_container_width=True)
 
             # --- Download options ---
             if export_format == "Excel":
-                excel_path = os.path.join(OUTPUT_DIR, FILENAME)
-                df.to_excel(excel_path, index=False)
-                with open(excel_path, "rb") as f:
-                    st.download_button(
-                        label="⬇️ Download Excel",
-                        data=f,
-                        file_name=FILENAME,
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                    )
+                buffer = io.BytesIO()
+                with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
+                    df.to_excel(writer, index=False, sheet_name="TestCases")
+                st.download_button(
+                    label="⬇️ Download Excel",
+                    data=buffer.getvalue(),
+                    file_name=FILENAME,
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                )
             else:
-                csv_data = df.to_csv(index=False)
+                # pyarrow is only needed for CSV exports, so import it on demand.
+                import pyarrow as pa
+                import pyarrow.csv as pacsv
+
+                buffer = io.BytesIO()
+                pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), buffer)
                 st.download_button(
                     label="⬇️ Download CSV",
-                    data=csv_data,
+                    data=buffer.getvalue(),
                     file_name="jira_test_cases.csv",
                     mime="text/csv",
                 )
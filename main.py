@@ -1,9 +1,14 @@
+import asyncio
+import json
 import pandas as pd
 from datetime import datetime
 from jira import JIRA
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import os
-import time
+import random
+import re
+from typing_extensions import TypedDict
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -19,94 +24,193 @@ GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 
 MAX_RETRIES = 3
 RETRY_DELAY = 5  # seconds
+MAX_RETRY_DELAY = 30  # seconds
+MAX_CONCURRENCY = 8  # in-flight Gemini requests
+
+# Gemini errors worth retrying; anything else (bad prompt, auth) fails fast.
+RETRYABLE_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+)
 
 OUTPUT_DIR = "output"
 FILENAME = "jira_test_cases.xlsx"
+MAX_DESCRIPTION_CHARS = 3000
+
+PROMPT_TEMPLATE = '''
+You are a highly skilled QA engineer. Given the following Jira user story, generate exhaustive but realistic test cases and return them as a JSON array. 
+Each test case should cover a unique scenario (positive and negative), with preconditions, clear multi-step instructions, and explicit expected results. 
+Do not make up features not described.
+
+Jira Story Summary: {summary}
+Jira Description: {description}
+
+Please output only the JSON array, one object per test case.
+'''
 
-# Connect to Jira
-jira = JIRA(
-    server=JIRA_SERVER,
-    basic_auth=(JIRA_EMAIL, JIRA_API_TOKEN)
+TEST_CASE_COLUMNS = [
+    "Test Case ID",
+    "Test Scenario",
+    "Preconditions",
+    "Steps",
+    "Expected Result",
+    "Priority",
+    "Jira ID",
+    "Story Summary",
+]
+
+class TestCaseRecord(TypedDict):
+    """Response schema for one generated test case."""
+    test_case_id: str
+    test_scenario: str
+    preconditions: str
+    steps: str
+    expected_result: str
+    priority: str
+
+# Maps response schema fields to the exported column names.
+RECORD_COLUMNS = dict(zip(TestCaseRecord.__annotations__, TEST_CASE_COLUMNS))
+
+# Ask Gemini for JSON matching the schema instead of a Markdown table.
+GENERATION_CONFIG = genai.types.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=list[TestCaseRecord],
 )
-issues = jira.search_issues(f'project={PROJECT_KEY} AND issuetype=Story AND status="To Do"', maxResults=10)
-
-# Initialize Gemini Pro client
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel(GEMINI_MODEL)
-
-def generate_test_cases(prompt_text):
-    for attempt in range(1, MAX_RETRIES + 1):
-        try:
-            response = model.generate_content(prompt_text)
-            return response.text
-        except Exception as e:
-            print(f"⚠️ Attempt {attempt} failed: {e}")
-            if attempt < MAX_RETRIES:
-                print(f"⏳ Retrying in {RETRY_DELAY} seconds...")
-                time.sleep(RETRY_DELAY)
+
+BR_TAG_RE = re.compile(r"<br\s*/?>", re.IGNORECASE)
+# Jira wiki formatting macros such as {color:red}, {panel:title=x} or {code}.
+WIKI_MACRO_RE = re.compile(r"\{(?:color|panel|quote|noformat|code)(?::[^}]*)?\}")
+BLANK_LINES_RE = re.compile(r"\n\s*\n\s*\n+")
+
+def backoff_delay(attempt, base=RETRY_DELAY):
+    """Exponential backoff with jitter for the given 1-based attempt."""
+    return min(MAX_RETRY_DELAY, base * 2 ** (attempt - 1)) * (0.5 + random.random())
+
+async def generate_test_cases(model, prompt_text, semaphore):
+    async with semaphore:
+        for attempt in range(1, MAX_RETRIES + 1):
+            try:
+                response = await model.generate_content_async(prompt_text)
+                return response.text
+            except RETRYABLE_ERRORS as e:
+                print(f"⚠️ Attempt {attempt} failed: {e}")
+                if attempt < MAX_RETRIES:
+                    delay = backoff_delay(attempt)
+                    print(f"⏳ Retrying in {delay:.1f} seconds...")
+                    await asyncio.sleep(delay)
+            except Exception as e:
+                print(f"❌ Request failed, not retrying: {e}")
+                return ""
     return ""
 
-def parse_markdown_table(md_text):
-    lines = [line.strip() for line in md_text.strip().split('\n') if '|' in line]
-    if len(lines) < 2:
-        return []
-    headers = [h.strip() for h in lines[0].split('|') if h.strip()]
-    rows = []
-    for line in lines[2:]:
-        fields = [f.strip() for f in line.split('|') if f.strip()]
-        if len(fields) == len(headers):
-            row = dict(zip(headers, fields))
-            rows.append(row)
-    return rows
-
-def clean_html_br_tags_and_strip(text):
+async def generate_all_test_cases(model, prompts):
+    """Run one Gemini request per prompt concurrently, preserving order."""
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    return await asyncio.gather(*(generate_test_cases(model, p, semaphore) for p in prompts))
+
+def trim_description(text, max_chars=MAX_DESCRIPTION_CHARS):
+    """Strip wiki macros and keep the head and tail of overly long descriptions.
+
+    Acceptance criteria usually sit at the end of a story, so the last third
+    of the budget is spent on the tail.
+    """
     if not text:
         return text
-    return text.replace('<br>', '\n').replace('<br/>', '\n').replace('<br />', '\n').strip()
+    text = BLANK_LINES_RE.sub("\n\n", WIKI_MACRO_RE.sub("", text)).strip()
+    if len(text) <= max_chars:
+        return text
+    head, tail = max_chars * 2 // 3, max_chars // 3
+    return text[:head] + "\n...[truncated]...\n" + text[-tail:]
+
+def parse_test_cases(json_text):
+    """Turn a JSON test case response into rows keyed by column name."""
+    try:
+        records = json.loads(json_text)
+    except ValueError:
+        return []
+    if not isinstance(records, list):
+        return []
+    return [
+        {
+            col: "" if record.get(field) is None else str(record[field])
+            for field, col in RECORD_COLUMNS.items()
+        }
+        for record in records
+        if isinstance(record, dict)
+    ]
+
+def _clean_html_br_tags_column(col):
+    if not pd.api.types.is_string_dtype(col):
+        return col
+    # Most cells have no <br>, so only run the regex when one is present.
+    if col.str.contains('<br', case=False, regex=False).any():
+        col = col.str.replace(BR_TAG_RE, '\n', regex=True)
+    return col.str.strip()
+
+def clean_html_br_tags_in_frame(df):
+    """Replace <br> tags with newlines and strip every string column of df."""
+    return df.apply(_clean_html_br_tags_column)
 
-def save_to_excel(parsed_rows, filename):
+def test_cases_to_frame(rows, jira_id, story_summary):
+    """Build one story's DataFrame column by column and stamp its Jira ID and summary."""
+    columns = {col: [row[col] for row in rows] for col in RECORD_COLUMNS.values()}
+    df = pd.DataFrame(columns, copy=False)
+    df["Jira ID"] = jira_id
+    df["Story Summary"] = story_summary
+    return df
+
+def combine_test_case_frames(frames):
+    """Concatenate per-story frames into one with TEST_CASE_COLUMNS."""
+    if not frames:
+        return pd.DataFrame(columns=TEST_CASE_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+def save_to_excel(df, filename):
     if not os.path.exists(OUTPUT_DIR):
         os.makedirs(OUTPUT_DIR)
-    if parsed_rows:
-        for row in parsed_rows:
-            for key, value in row.items():
-                if isinstance(value, str):
-                    row[key] = clean_html_br_tags_and_strip(value)
-        df = pd.DataFrame(parsed_rows)
+    if not df.empty:
+        df = clean_html_br_tags_in_frame(df)
         timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         file_path = os.path.join(OUTPUT_DIR, filename.replace(".xlsx", f"_{timestamp}.xlsx"))
-        df.to_excel(file_path, index=False)
+        df.to_excel(file_path, index=False, engine="xlsxwriter")
         print(f"✅ Excel file created: {file_path}")
     else:
         print("⚠️ No test cases to write.")
 
 if __name__ == "__main__":
-    all_rows = []
+    # Clients are only created when run as a script, so that app.py can import
+    # the helpers above without connecting to Jira or Gemini.
+    jira = JIRA(
+        server=JIRA_SERVER,
+        basic_auth=(JIRA_EMAIL, JIRA_API_TOKEN)
+    )
+    issues = jira.search_issues(
+        f'project={PROJECT_KEY} AND issuetype=Story AND status="To Do"',
+        maxResults=10,
+        fields="summary,description",
+    )
+
+    genai.configure(api_key=GEMINI_API_KEY)
+    model = genai.GenerativeModel(GEMINI_MODEL, generation_config=GENERATION_CONFIG)
+
+    prompts = []
     for issue in issues:
-        story_summary = issue.fields.summary
-        story_description = issue.fields.description or "No description provided."
-        prompt = f'''
-You are a highly skilled QA engineer. Given the following Jira user story, generate exhaustive but realistic test cases and format them in a Markdown table. 
-Each test case should cover a unique scenario (positive and negative), with preconditions, clear multi-step instructions, and explicit expected results. 
-Do not make up features not described.
+        story_description = trim_description(issue.fields.description) or "No description provided."
+        prompts.append(PROMPT_TEMPLATE.format(summary=issue.fields.summary, description=story_description))
+        print(f"Issue: {issue.key} - {issue.fields.summary}")
 
-Jira Story Summary: {story_summary}
-Jira Description: {story_description}
+    print("Generating test cases...")
+    results = asyncio.run(generate_all_test_cases(model, prompts))
 
-Please output only the Markdown table with the following columns:
-| Test Case ID | Test Scenario | Preconditions | Steps | Expected Result | Priority |
-'''
-        print("----------------------------------------------------")
-        print(f"Issue: {issue.key} - {story_summary}")
-        print("Generating test cases...")
-        test_table_md = generate_test_cases(prompt)
-        case_rows = parse_markdown_table(test_table_md)
-        for row in case_rows:
-            row["Jira ID"] = issue.key
-            row["Story Summary"] = story_summary
-            all_rows.append(row)
+    frames = []
+    for issue, response_text in zip(issues, results):
+        case_rows = parse_test_cases(response_text)
+        if case_rows:
+            frames.append(test_cases_to_frame(case_rows, issue.key, issue.fields.summary))
         print("✅ Generated Test Cases for:", issue.key)
-        print("----------------------------------------------------\n")
+    print("----------------------------------------------------\n")
 
-    save_to_excel(all_rows, FILENAME)
+    save_to_excel(combine_test_case_frames(frames), FILENAME)
     print("🎉 All done! Test cases saved in Excel.")